@@ -0,0 +1,150 @@
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+
+# Binary per-packet arrival log.
+#
+# The file starts with a 16 bytes header (8 bytes magic, 8 bytes number of
+# valid records) followed by fixed-width little-endian records:
+#
+#   packet_id (u32) | seq (u32) | kernel_ts_ns (u64)
+#
+# The file is preallocated and memory-mapped, records are written in place and
+# the header is only updated every flush_every records, keeping the per-packet
+# cost to a single struct.pack_into(). Readers see the records through the
+# shared mapping, the mapping is synced to disk every sync_interval seconds by
+# a background thread, so that the receive path never waits for the disk.
+
+MAGIC = b'ULPARRV1'
+HEADER = struct.Struct('<8sQ')
+RECORD = struct.Struct('<IIQ')
+
+# Linux values, not exported by the socket module
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+TIMESPEC = struct.Struct('@qq')
+ANCBUFSIZE = socket.CMSG_SPACE(TIMESPEC.size)
+
+class ArrivalRecorder:
+    def __init__(self, filename, capacity=1 << 20, flush_every=4096,
+                 sync_interval=1.0):
+        self.filename = filename
+        self.flush_every = flush_every
+        self.sync_interval = sync_interval
+        self.nrecords = 0
+        self.flushed = 0
+        # protect the mapping from the syncer thread while it is replaced
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self.file = open(filename, 'w+b')
+        self.map_file(capacity)
+        HEADER.pack_into(self.mm, 0, MAGIC, 0)
+
+        self.syncer_thread = threading.Thread(target=self.syncer, daemon=True)
+        self.syncer_thread.start()
+
+    def map_file(self, capacity):
+        self.capacity = capacity
+        self.file.truncate(HEADER.size + capacity * RECORD.size)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+
+    # Double the size of the log when it is full
+    def grow(self):
+        with self.lock:
+            self.flush()
+            self.mm.close()
+            self.map_file(self.capacity * 2)
+
+    def record(self, packet_id, seq, ts_ns):
+        n = self.nrecords
+        if n == self.capacity:
+            self.grow()
+
+        RECORD.pack_into(self.mm, HEADER.size + n * RECORD.size, packet_id,
+                         seq, ts_ns)
+        self.nrecords = n + 1
+
+        if self.nrecords - self.flushed >= self.flush_every:
+            self.flush()
+
+    # Publish the records written so far in the header
+    def flush(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, self.nrecords)
+        self.flushed = self.nrecords
+
+    def syncer(self):
+        while not self.stopping.wait(self.sync_interval):
+            with self.lock:
+                self.mm.flush()
+
+    def close(self):
+        if self.mm.closed:
+            return
+
+        self.stopping.set()
+        self.syncer_thread.join()
+
+        self.flush()
+        self.mm.flush()
+        self.mm.close()
+        # drop the unused preallocated space
+        self.file.truncate(HEADER.size + self.nrecords * RECORD.size)
+        self.file.close()
+
+# Ask the kernel to timestamp every received datagram
+def enable_kernel_timestamps(sock):
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        return True
+    except OSError:
+        return False
+
+# Same as sock.recvfrom(), but also return the kernel receive timestamp in
+# nanoseconds (or the current time if the kernel did not provide one).
+def recvfrom_ts(sock, bufsize):
+    data, ancdata, flags, addr = sock.recvmsg(bufsize, ANCBUFSIZE)
+    for level, ctype, cdata in ancdata:
+        if level == socket.SOL_SOCKET and ctype == SCM_TIMESTAMPNS:
+            sec, nsec = TIMESPEC.unpack_from(cdata)
+            return data, addr, sec * 1000000000 + nsec
+
+    return data, addr, time.time_ns()
+
+# Same as recvfrom_ts(), but receive into a preallocated buffer like
+# sock.recvfrom_into(). Return (nbytes, addr, timestamp).
+def recvfrom_into_ts(sock, buf):
+    nbytes, ancdata, flags, addr = sock.recvmsg_into([buf], ANCBUFSIZE)
+    for level, ctype, cdata in ancdata:
+        if level == socket.SOL_SOCKET and ctype == SCM_TIMESTAMPNS:
+            sec, nsec = TIMESPEC.unpack_from(cdata)
+            return nbytes, addr, sec * 1000000000 + nsec
+
+    return nbytes, addr, time.time_ns()
+
+# Map an arrival log as a NumPy structured array, without copying it
+def load(filename):
+    # NumPy is only needed for the analysis
+    import numpy as np
+
+    dtype = np.dtype([('packet_id', '<u4'), ('seq', '<u4'),
+                      ('kernel_ts_ns', '<u8')])
+
+    with open(filename, 'rb') as f:
+        magic, nrecords = HEADER.unpack(f.read(HEADER.size))
+
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not an arrival log")
+
+    if nrecords == 0:
+        return np.empty(0, dtype=dtype)
+
+    return np.memmap(filename, dtype=dtype, mode='r', offset=HEADER.size,
+                     shape=(nrecords,))
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+# Benchmark suite for the measurement engine itself.
+#
+# Microbenchmarks time MSession.count_packet and get_missing_packets_seqnum
+# and measure the memory taken by a session. Loopback benchmarks run a
+# UDPServer (in a child process) against UDPClient sessions at increasing
+# rates, in both directions, to find the maximum rate the tool itself sustains
+# without losing packets, and the CPU time the receiving side spends per packet.
+# The sending side is not measured: its CPU time is dominated by the busy wait
+# of the pacer, i.e., about 1/rate per packet whatever the engine cost.
+#
+# Results are written as JSON and can be compared against a stored baseline.
+
+import argparse
+import contextlib
+import datetime
+import gc
+import io
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import common
+
+# A session takes about 84 bytes per packet, i.e., about 8 GB at 1e8 packets:
+# the largest sizes are only run on request (--large).
+DEFAULT_SIZES = [10 ** 4, 10 ** 5, 10 ** 6]
+LARGE_SIZES = [10 ** 7, 10 ** 8]
+DEFAULT_RATES = [1000, 2000, 5000, 10000, 20000, 50000, 100000]
+
+# A loopback step only passes if no packet is lost and the achieved rate is
+# at least this fraction of the requested one.
+MIN_RATE_RATIO = 0.95
+
+# For each compared metric: True if higher is better
+METRICS = {
+    'ns_per_packet': False,
+    'bytes_per_packet': False,
+    'ns_per_expected_packet': False,
+    'max_lossfree_pps': True,
+    'receiver_cpu_ns_per_packet': False,
+}
+
+# Run func repeat times with the garbage collector disabled and return the
+# best wall clock time.
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def fill_session(npackets, loss_every=0):
+    session = common.MSession(1, npackets)
+    count_packet = session.count_packet
+    for i in range(npackets):
+        if loss_every and i % loss_every == 0:
+            continue
+        count_packet(i)
+
+    return session
+
+def bench_count_packet(npackets, repeat):
+    elapsed = best_time(lambda: fill_session(npackets), repeat)
+
+    tracemalloc.start()
+    session = fill_session(npackets)
+    session_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del session
+
+    return {
+        'packets': npackets,
+        'ns_per_packet': round(elapsed * 1e9 / npackets, 2),
+        'bytes_per_session': session_bytes,
+        'bytes_per_packet': round(session_bytes / npackets, 2),
+    }
+
+def bench_missing(npackets, repeat, loss_every=100):
+    session = fill_session(npackets, loss_every)
+    nranges = len(session.get_missing_packets_seqnum())
+    elapsed = best_time(session.get_missing_packets_seqnum, repeat)
+
+    return {
+        'packets': npackets,
+        'missing_ranges': nranges,
+        'ns_per_expected_packet': round(elapsed * 1e9 / npackets, 2),
+    }
+
+def run_micro(sizes, repeat):
+    results = {'count_packet': [], 'get_missing_packets_seqnum': []}
+
+    for npackets in sizes:
+        print(f"micro: {npackets} packets", file=sys.stderr)
+        results['count_packet'].append(bench_count_packet(npackets, repeat))
+        results['get_missing_packets_seqnum'].append(
+                bench_missing(npackets, repeat))
+
+    return results
+
+# Child process: run a UDPServer on the loopback and answer to stats requests
+def server_process(conn, workdir):
+    import server
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        srv = server.UDPServer(host='127.0.0.1', port=0,
+                               output_file=os.path.join(workdir,
+                                                        'server.json'))
+        srv.start()
+        conn.send(srv.sock.getsockname()[1])
+
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+
+            if request == 'cpu':
+                conn.send(time.process_time())
+                continue
+
+            info = srv.packet_info.get(request)
+            conn.send(dict(info) if info is not None else None)
+
+        srv.stop()
+
+def run_loopback_step(conn, port, workdir, direction, rate, duration):
+    import client
+
+    npackets = int(rate * duration)
+    with contextlib.redirect_stdout(io.StringIO()):
+        cli = client.UDPClient(host='127.0.0.1', port=port,
+                               packets_to_send=npackets, rate=rate,
+                               direction=direction,
+                               id_file=os.path.join(workdir, 'used_ids.txt'),
+                               output_file=os.path.join(workdir,
+                                                        'client.json'))
+
+        conn.send('cpu')
+        server_cpu = conn.recv()
+        client_cpu = time.process_time()
+
+        cli.start()
+
+        client_cpu = time.process_time() - client_cpu
+
+        # let the server drain its socket
+        time.sleep(0.5)
+        conn.send('cpu')
+        server_cpu = conn.recv() - server_cpu
+
+        # The achieved rate is measured by the receiver, from the first to
+        # the last packet: after the last packet of a lossy download, the
+        # client waits for a whole receive timeout. For an upload, the server
+        # also sees the start of transmission packets, sent at the same rate.
+        if direction == 0:
+            conn.send(cli.packet_id)
+            info = conn.recv()
+            received = info['count'] if info else 0
+            sent_before = client.START_TX_PACKETS
+            receiver_cpu = server_cpu
+        else:
+            info = cli.packet_info[cli.packet_id]
+            received = info['count']
+            sent_before = 0
+            receiver_cpu = client_cpu
+
+    achieved_pps = None
+    if received > 1 and info['last_seen'] > info['first_seen']:
+        achieved_pps = round((sent_before + received - 1) /
+                             (info['last_seen'] - info['first_seen']), 1)
+
+    return {
+        'rate': rate,
+        'packets': npackets,
+        'received': received,
+        'loss_ratio': round(1 - received / npackets, 6),
+        'achieved_pps': achieved_pps,
+        'receiver_cpu_ns_per_packet': round(receiver_cpu * 1e9 / npackets, 1),
+    }
+
+# Return True if the step lost no packet and achieved the requested rate
+def step_passed(step):
+    return (step['received'] == step['packets'] and
+            step['achieved_pps'] is not None and
+            step['achieved_pps'] >= step['rate'] * MIN_RATE_RATIO)
+
+def run_loopback(rates, duration):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='udp-loss-bench-')
+    parent_conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=server_process,
+                                   args=(child_conn, workdir), daemon=True)
+    proc.start()
+    port = parent_conn.recv()
+
+    try:
+        for direction, name in ((0, 'up'), (1, 'down')):
+            steps = []
+            max_lossfree = 0
+            for rate in rates:
+                print(f"loopback: {name} at {rate} pps", file=sys.stderr)
+                step = run_loopback_step(parent_conn, port, workdir,
+                                         direction, rate, duration)
+                steps.append(step)
+                if not step_passed(step):
+                    # no point in going faster
+                    break
+                max_lossfree = rate
+
+            lossfree = [s for s in steps if step_passed(s)]
+            results[name] = {
+                'max_lossfree_pps': max_lossfree,
+                'receiver_cpu_ns_per_packet':
+                    lossfree[-1]['receiver_cpu_ns_per_packet'] if lossfree
+                    else None,
+                'steps': steps,
+            }
+    finally:
+        parent_conn.send(None)
+        proc.join(5)
+
+    return results
+
+# Flatten the report into {metric path: value} for the compared metrics
+def flatten(report, prefix=''):
+    values = {}
+    for key, value in report.items():
+        path = f"{prefix}{key}"
+        if key == 'steps':
+            # only the per-direction summary is compared
+            continue
+        elif isinstance(value, dict):
+            values.update(flatten(value, path + '.'))
+        elif isinstance(value, list):
+            # list of per-size results, keyed by packet number
+            for item in value:
+                if isinstance(item, dict) and 'packets' in item:
+                    values.update(flatten(item,
+                                          f"{path}[{item['packets']}]."))
+        elif key in METRICS and value is not None:
+            values[path] = value
+
+    return values
+
+# Compare a report against a baseline, return the list of regressions
+def compare(report, baseline, tolerance):
+    current = flatten(report)
+    regressions = []
+
+    for path, old in sorted(flatten(baseline).items()):
+        if path not in current or old == 0:
+            continue
+
+        new = current[path]
+        change = (new - old) / old
+        higher_is_better = METRICS[path.rsplit('.', 1)[-1]]
+        worse = change < -tolerance if higher_is_better else change > tolerance
+
+        mark = 'REGRESSION' if worse else 'ok'
+        print(f"{path}: {old} -> {new} ({change:+.1%}) {mark}")
+        if worse:
+            regressions.append(path)
+
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UDP loss tool benchmarks")
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=DEFAULT_SIZES,
+                        help='Session sizes for the microbenchmarks '
+                             '(default: 1e4 to 1e6 packets)')
+    parser.add_argument('--large', action='store_true',
+                        help='Also run the microbenchmarks at 1e7 and 1e8 '
+                             'packets (about 8 GB of memory)')
+    parser.add_argument('-r', '--rates', type=int, nargs='+',
+                        default=DEFAULT_RATES,
+                        help='Packet rates for the loopback benchmarks')
+    parser.add_argument('-t', '--duration', type=float, default=2,
+                        help='Duration of each loopback step in seconds')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Repetitions of each microbenchmark')
+    parser.add_argument('--no-micro', action='store_true',
+                        help='Skip the microbenchmarks')
+    parser.add_argument('--no-loopback', action='store_true',
+                        help='Skip the loopback benchmarks')
+    parser.add_argument('-o', '--output', type=str,
+                        help='Write the results to this JSON file')
+    parser.add_argument('-c', '--compare', type=str,
+                        help='Compare the results against this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed relative regression (default: 0.1)')
+
+    args = parser.parse_args()
+
+    report = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+    }
+
+    if not args.no_micro:
+        sizes = args.sizes + LARGE_SIZES if args.large else args.sizes
+        report['micro'] = run_micro(sizes, args.repeat)
+    if not args.no_loopback:
+        report['loopback'] = run_loopback(args.rates, args.duration)
+
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump(report, json_file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.compare:
+        with open(args.compare, 'r') as json_file:
+            baseline = json.load(json_file)
+
+        if compare(report, baseline, args.tolerance):
+            exit(1)
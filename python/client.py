@@ -3,7 +3,9 @@
 import socket
 import threading
 import time
+import math
 import random
+import array
 import struct
 import json
 import os
@@ -13,8 +15,14 @@ import argparse
 import datetime
 import subprocess
 import common
+import sqlstore
+import arrivallog
+import metrics
+import patterns
 from enum import Enum
-from collections import defaultdict
+
+# packets sent (at the session rate) to notify the start of a transmission
+START_TX_PACKETS = 100
 
 class SenderDownloadError(Exception):
     """Exception raised for errors in the sender download process."""
@@ -24,14 +32,35 @@ class TransmissionState(Enum):
     START_TX    = 1
     SEND_DATA   = 2
 
+class ClientMetrics(metrics.Metrics):
+    def __init__(self, sample_every=64):
+        super().__init__('udploss_client', sample_every)
+        self.sent = self.counter('packets_sent', 'Packets sent')
+        self.late = self.counter('packets_late',
+                                 'Packets sent after their pacing slot')
+        self.received = self.counter('packets_received',
+                                     'Packets received on the socket')
+        self.pacing = self.timer('pacing_lateness',
+                                 'Delay of the sender past its pacing slot '
+                                 '(sampled)')
+        self.recv_wait = self.timer('receive_syscall',
+                                    'Time spent in recvfrom(), including the '
+                                    'wait for data (sampled)')
+        self.accounting = self.timer('accounting',
+                                     'Time spent counting packets (sampled)')
+        self.persistence = self.timer('persistence',
+                                      'Time spent saving the results')
+
 # Define the UDP client
 class UDPClient:
     def __init__(self, host, port=12345, packets_to_send=600,
                  rate=100, direction=0, id_file='data/used_ids.txt',
-                 interface=None, output_file=None):
+                 interface=None, output_file=None, sqlite_file=None,
+                 arrival_log=None, metrics_port=None, echo_grace=2.0,
+                 pattern=None, flows=1):
         # Each packet ID will map to a dictionary with count, first_seen,
         # last_seen, packet_rate, total_packets, direction
-        self.packet_info = defaultdict(lambda: {
+        self.packet_info = common.SessionTable(lambda: {
             'count': 0,
             'duplicates': 0,
             'first_seen': None,
@@ -40,7 +69,23 @@ class UDPClient:
             'total_packets': 0,
             'direction': 0,
         })
+        if flows < 1 or flows > 0xffff:
+            raise ValueError(f"invalid number of flows: {flows}")
+        if flows > 1 and direction != common.DIRECTION_UP:
+            raise ValueError("multiple flows are only supported for upload")
+        if arrival_log and direction == common.DIRECTION_UP:
+            # nothing is received in upload mode
+            raise ValueError("the arrival log is not supported for upload")
+        if sqlite_file and direction == common.DIRECTION_UP:
+            # upload sessions are stored by the server
+            raise ValueError("the SQLite database is not supported for upload")
+
         self.packets_to_send = packets_to_send
+        # packets are spread over this number of source ports
+        self.flows = flows
+        self.socks = []
+        # traffic pattern of the data packets (constant bit rate by default)
+        self.pattern = patterns.TrafficPattern() if pattern is None else pattern
         self.server_address = (host, port)
         self.receive_running = False
         self.direction = direction
@@ -60,6 +105,33 @@ class UDPClient:
 
         self.msession = common.MSession(self.packet_id, self.packets_to_send)
 
+        # Every packet carries the traffic pattern in the padding, so that the
+        # server can record it (and use it for download sessions), and the
+        # flow index if the session has multiple flows.
+        self.paddings = [self.build_padding(flow) for flow in range(flows)]
+        self.echo_padding = self.paddings[0][common.ECHO_TIMESTAMP.size:]
+
+        # optional SQLite backend (download and echo only), written off the
+        # receive thread
+        self.store = (sqlstore.SQLiteStore(sqlite_file, "client")
+                      if sqlite_file else None)
+
+        # optional per-packet arrival log (download and echo only)
+        self.recorder = (arrivallog.ArrivalRecorder(arrival_log)
+                         if arrival_log else None)
+
+        # optional instrumentation, served over HTTP
+        self.metrics_port = metrics_port
+        self.metrics = ClientMetrics() if metrics_port is not None else None
+
+        # echo mode: how long to wait for the echoes after the last packet
+        # has been sent, the round-trip time of every packet (-1 if not
+        # received) and the highest server echo counter seen.
+        self.echo_grace = echo_grace
+        self.echo_deadline = None
+        self.rtts = None
+        self.echo_counter = 0
+
     # Load used packet IDs from a file
     def load_used_ids(self):
         if os.path.exists(self.id_file):
@@ -83,13 +155,36 @@ class UDPClient:
                 self.save_used_id(packet_id)   # Save the ID to the file
                 return packet_id
 
+    def build_padding(self, flow):
+        padding = (bytes(patterns.WIRE_OFFSET - common.HEADER.size) +
+                   self.pattern.pack() +
+                   bytes(common.FLOW_OFFSET - patterns.WIRE_OFFSET -
+                         patterns.WIRE.size))
+        if self.flows > 1:
+            padding += common.FLOW.pack(flow, self.flows)
+        else:
+            padding += bytes(common.FLOW.size)
+
+        return padding + bytes(common.PACKET_SIZE - common.FLOW_OFFSET -
+                               common.FLOW.size)
+
     def send_packet(self, packet_id, packet_num, packet_rate, total_packets,
-                    direction):
+                    direction, flow=0):
             # Create the packet data
-            packet_data = struct.pack('!IIIII', packet_id, packet_num,
-                                      packet_rate, total_packets,
-                                      direction) + b'\x00' * (64 - 20)
-            self.sock.sendto(packet_data, self.server_address)
+            packet_data = common.HEADER.pack(packet_id, packet_num,
+                                             packet_rate, total_packets,
+                                             direction) + self.paddings[flow]
+            self.socks[flow].sendto(packet_data, self.server_address)
+
+    # Send an echo packet carrying the current time, the server will reflect
+    # it back as is.
+    def send_echo_packet(self, packet_id, packet_num, packet_rate,
+                         total_packets, direction, flow=0):
+        packet_data = (common.HEADER.pack(packet_id, packet_num, packet_rate,
+                                          total_packets, direction) +
+                       common.ECHO_TIMESTAMP.pack(time.perf_counter_ns()) +
+                       self.echo_padding)
+        self.sock.sendto(packet_data, self.server_address)
 
     def __send_packets(self, op, tx_packets_to_send):
         # Prepare the packet header with the packet rate and total number of
@@ -98,14 +193,24 @@ class UDPClient:
         packet_id = self.packet_id
         direction = self.direction
         packet_rate = self.rate
+        metrics = self.metrics
+        nflows = self.flows
+
+        send_packet = self.send_packet
+        if (direction == common.DIRECTION_ECHO and
+                op == TransmissionState.SEND_DATA):
+            send_packet = self.send_echo_packet
+
+        # the start of the transmission is always paced at constant bit rate
+        pattern = (self.pattern if op == TransmissionState.SEND_DATA
+                   else patterns.TrafficPattern())
+        offsets = pattern.schedule(packet_rate, tx_packets_to_send)
 
         # Create a packet format: 4 bytes for packet ID, 4 bytes for packet
         # rate, 4 bytes for total packets, 4 byte for direction.
         # This is a total of 16 bytes, leaving 48 bytes for padding to reach at
         # least 64 bytes
-        for i in range(tx_packets_to_send):
-            budget = time.perf_counter() + (1.0 / packet_rate)
-
+        for i in patterns.pace(offsets, metrics):
             # we start a transmission, so we send packets with a specific
             # packet_number to notify the receiver that it needs to prepare for
             # receiving incoming packets.
@@ -114,19 +219,21 @@ class UDPClient:
             else:
                 packet_num = i
 
-            self.send_packet(packet_id, packet_num, packet_rate, total_packets,
-                             direction)
+            # packet i always goes on flow i % nflows, see common.FlowStats
+            send_packet(packet_id, packet_num, packet_rate, total_packets,
+                        direction, i % nflows)
 
-            while time.perf_counter() - budget < 0:
-                pass
+            if metrics:
+                metrics.sent.value += 1
 
     def send_packets(self):
         # notify the remote endpoint a tx is starting
-        self.__send_packets(TransmissionState.START_TX, 100)
+        self.__send_packets(TransmissionState.START_TX, START_TX_PACKETS)
 
         # start transmitting the real data
         self.__send_packets(TransmissionState.SEND_DATA, self.packets_to_send)
-        self.sock.close()
+        for sock in self.socks:
+            sock.close()
 
     def send_download_request(self):
         total_packets = self.packets_to_send
@@ -136,10 +243,12 @@ class UDPClient:
         # packet number.
         packet_num = (2**32) - 1
         packet_rate = self.rate
+        # keep asking for as long as the client waits for the next packet
+        retries = math.ceil(self.receive_timeout * packet_rate)
         retry = 0
 
         # Send the control message packet for starting the Client DOWNLOAD
-        while retry < total_packets:
+        while retry < retries:
             count = self.packet_info[packet_id]['count']
             if count and count > 0:
                 # Client started to receive DOWNLOAD traffic from the server
@@ -151,12 +260,12 @@ class UDPClient:
             common.send_rate_sleep(packet_rate)
             retry += 1
 
-        if retry != total_packets:
+        if retry != retries:
             # the receiver is receiving download traffic
             return 0
 
-        # Number of retries exceeded the threshold (fixed as the total number
-        # of packets supposed to be sent by the server).
+        # Number of retries exceeded the threshold (one request per packet
+        # slot of the receive timeout).
         self.sock.close()
         raise SenderDownloadError("sender download failed: no server response")
 
@@ -164,11 +273,31 @@ class UDPClient:
     def receive_packets_core(self):
         timeout = -1
 
+        recorder = self.recorder
+        metrics = self.metrics
+        sampled = False
+
         # Notify that receive_packets thread has been run
         self.receive_running = True
 
         while self.running:
-            data, addr = self.sock.recvfrom(1024)  # Buffer size is 1024 bytes
+            if metrics:
+                sampled = metrics.sample()
+                if sampled:
+                    t_recv = time.perf_counter_ns()
+
+            if recorder:
+                data, addr, ts_ns = arrivallog.recvfrom_ts(self.sock, 1024)
+            else:
+                # Buffer size is 1024 bytes
+                data, addr = self.sock.recvfrom(1024)
+
+            if metrics:
+                metrics.received.value += 1
+                if sampled:
+                    t_accounting = time.perf_counter_ns()
+                    metrics.recv_wait.observe(t_accounting - t_recv)
+
             if len(data) >= 64:
                 packet_id = int.from_bytes(data[:4], byteorder='big')
                 if packet_id != self.packet_id:
@@ -178,6 +307,8 @@ class UDPClient:
                     continue
 
                 packet_number = int.from_bytes(data[4:8], byteorder='big')
+                if recorder:
+                    recorder.record(packet_id, packet_number, ts_ns)
                 packet_rate = int.from_bytes(data[8:12], byteorder='big')
                 total_packets = int.from_bytes(data[12:16], byteorder='big')
                 direction = int.from_bytes(data[16:20], byteorder='big')
@@ -199,6 +330,11 @@ class UDPClient:
                     self.packet_info[packet_id]['count'] += 1
                 else:
                     self.packet_info[packet_id]['duplicates'] += 1
+                self.packet_info.touch(packet_id)
+
+                if sampled:
+                    metrics.accounting.observe(time.perf_counter_ns() -
+                                               t_accounting)
 
                 # To exit from this loop we have different conditions
 
@@ -209,13 +345,13 @@ class UDPClient:
                     # have been received.
                     return
 
-                duration = total_packets/packet_rate
                 if timeout >= 0:
                     # timeout has been already set, jump back to the beginning
                     # of the loop
                     continue
 
-                timeout = duration
+                # wait longer than the idle gaps of the traffic pattern
+                timeout = self.receive_timeout
                 self.sock.settimeout(timeout)
 
     def receive_packets(self):
@@ -233,6 +369,11 @@ class UDPClient:
             os._exit(1)
 
     def start_download(self):
+        # the server paces the download with the requested pattern
+        self.packet_info[self.packet_id]['pattern'] = self.pattern.to_dict()
+        self.receive_timeout = self.pattern.receive_timeout(
+                self.rate, self.packets_to_send)
+
         # Start the display thread
         display_thread = threading.Thread(target=self.save_counts_to_file,
                                           daemon=True)
@@ -255,8 +396,150 @@ class UDPClient:
         # stop the display thread and close the socket
         self.stop()
 
+    def receive_echoes_core(self):
+        packet_id = self.packet_id
+        info = self.packet_info[packet_id]
+        total_packets = self.packets_to_send
+        recorder = self.recorder
+        metrics = self.metrics
+        rtts = self.rtts
+
+        # preallocated receive buffer
+        buf = bytearray(1024)  # Buffer size is 1024 bytes
+
+        # poll, so that we can stop once the grace period is over
+        self.sock.settimeout(0.1)
+        self.receive_running = True
+
+        while self.running:
+            try:
+                if recorder:
+                    nbytes, addr, ts_ns = arrivallog.recvfrom_into_ts(
+                            self.sock, buf)
+                else:
+                    nbytes, addr = self.sock.recvfrom_into(buf)
+            except socket.timeout:
+                if (self.echo_deadline is not None and
+                        time.monotonic() > self.echo_deadline):
+                    return
+                continue
+
+            now_ns = time.perf_counter_ns()
+            if metrics:
+                metrics.received.value += 1
+
+            if nbytes < common.PACKET_SIZE:
+                continue
+
+            rcv_packet_id, packet_number = common.HEADER.unpack_from(buf)[:2]
+            if rcv_packet_id != packet_id or packet_number >= total_packets:
+                continue
+
+            if recorder:
+                recorder.record(packet_id, packet_number, ts_ns)
+
+            current_time = time.time()
+            if info['first_seen'] is None:
+                info['first_seen'] = current_time
+            info['last_seen'] = current_time
+
+            if self.msession.count_packet(packet_number) == 1:
+                info['count'] += 1
+                sent_ns = common.ECHO_TIMESTAMP.unpack_from(
+                        buf, common.ECHO_TIMESTAMP_OFFSET)[0]
+                rtts[packet_number] = now_ns - sent_ns
+                echo_counter = common.ECHO_COUNTER.unpack_from(
+                        buf, common.ECHO_COUNTER_OFFSET)[0]
+                if echo_counter > self.echo_counter:
+                    self.echo_counter = echo_counter
+            else:
+                info['duplicates'] += 1
+            self.packet_info.touch(packet_id)
+
+            if info['count'] == total_packets:
+                # all the echoes are back
+                return
+
+    def receive_echoes(self):
+        try:
+            self.receive_echoes_core()
+        except Exception as e:
+            # other exceptions are fatal?! NO MERCY!
+            tb_exception = traceback.TracebackException.from_exception(e)
+            print("An exception occurred:")
+            print(''.join(tb_exception.format()))
+            os._exit(1)
+
+    # Compute the round-trip, forward and reverse losses and the RTT
+    # distribution of the echo session.
+    #
+    # The forward direction is accounted through the echo counter, i.e., the
+    # number of packets the server had received when it reflected the last
+    # echo we got. Packets received by the server after that echo whose
+    # echoes were all lost are thus accounted as forward losses.
+    def update_echo_stats(self):
+        info = self.packet_info[self.packet_id]
+        total_packets = self.packets_to_send
+        received = info['count']
+        forward_received = self.echo_counter
+
+        info['roundtrip_lost'] = total_packets - received
+        info['forward_received'] = forward_received
+        info['forward_lost'] = total_packets - forward_received
+        info['reverse_lost'] = forward_received - received
+
+        rtts = sorted(rtt for rtt in self.rtts if rtt >= 0)
+        if rtts:
+            info['rtt_min'] = rtts[0] / 1e9
+            info['rtt_avg'] = sum(rtts) / len(rtts) / 1e9
+            info['rtt_p50'] = rtts[len(rtts) // 2] / 1e9
+            info['rtt_p90'] = rtts[int(len(rtts) * 0.9)] / 1e9
+            info['rtt_p99'] = rtts[int(len(rtts) * 0.99)] / 1e9
+            info['rtt_max'] = rtts[-1] / 1e9
+
+        self.packet_info.touch(self.packet_id)
+
+    def start_echo(self):
+        info = self.packet_info[self.packet_id]
+        info['total_packets'] = self.packets_to_send
+        info['packet_rate'] = self.rate
+        info['direction'] = self.direction
+        info['pattern'] = self.pattern.to_dict()
+        self.rtts = array.array('q', [-1]) * self.packets_to_send
+
+        # Start the display thread
+        display_thread = threading.Thread(target=self.save_counts_to_file,
+                                          daemon=True)
+        display_thread.start()
+
+        # Start the receiving thread
+        rcv_thread = threading.Thread(target=self.receive_echoes, daemon=True)
+        rcv_thread.start()
+
+        # notify the remote endpoint a tx is starting
+        self.__send_packets(TransmissionState.START_TX, START_TX_PACKETS)
+
+        # start transmitting the real data
+        self.__send_packets(TransmissionState.SEND_DATA, self.packets_to_send)
+
+        # wait for the last echoes
+        self.echo_deadline = time.monotonic() + self.echo_grace
+        rcv_thread.join()
+
+        self.update_echo_stats()
+
+        # stop the display thread and close the socket
+        self.stop()
+
     def start(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # one socket (i.e., source port) per flow
+        self.socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                      for _ in range(self.flows)]
+        self.sock = self.socks[0]
+        if self.recorder:
+            arrivallog.enable_kernel_timestamps(self.sock)
+        if self.metrics:
+            self.metrics.serve(self.metrics_port)
 
         direction = self.direction
         if direction == 0:
@@ -269,6 +552,14 @@ class UDPClient:
             if self.interface:
                 self.stop_tcpdump()
 
+            if self.metrics:
+                self.metrics.stop()
+
+            return
+
+        if direction == common.DIRECTION_ECHO:
+            # echo mode (the server reflects the traffic back to this client)
+            self.start_echo()
             return
 
         # download mode (server sends traffic to this clien)
@@ -299,13 +590,30 @@ class UDPClient:
             pass
 
     def save_to_json(self):
-        packet_info_copy = self.packet_info.copy()
+        start_ns = time.perf_counter_ns()
+        packet_info_copy = self.packet_info.snapshot()
 
         with open(self.output_file, 'w') as json_file:
             # Pretty print the JSON
             json.dump(packet_info_copy, json_file, indent=4)
             print(f"Saved packet counts to {self.output_file}")
 
+        if self.store:
+            self.store.save_sessions(packet_info_copy)
+
+        if self.metrics:
+            self.metrics.persistence.observe(time.perf_counter_ns() - start_ns)
+
+    # Persist the missing ranges of the download session and flush the store
+    def stop_store(self):
+        if not self.store:
+            return
+
+        first_seen = self.packet_info[self.packet_id]['first_seen']
+        missing = self.msession.get_missing_packets_seqnum()
+        self.store.save_missing_ranges(self.packet_id, first_seen, missing)
+        self.store.stop()
+
     def save_counts_to_file(self):
         while self.running:
             time.sleep(5)
@@ -316,15 +624,22 @@ class UDPClient:
         self.sock.close()
         # save on disk
         self.save_to_json()
+        self.stop_store()
+        if self.recorder:
+            self.recorder.close()
+        if self.metrics:
+            self.metrics.stop()
         self.stop_tcpdump()
 
 def validate_direction(value):
     if value == 'up':
-        return 0
+        return common.DIRECTION_UP
     elif value == 'down':
-        return 1
+        return common.DIRECTION_DOWN
+    elif value == 'echo':
+        return common.DIRECTION_ECHO
     else:
-        raise argparse.ArgumentTypeError(f"Invalid value for direction: '{value}'. Must be 'up' or 'down'.")
+        raise argparse.ArgumentTypeError(f"Invalid value for direction: '{value}'. Must be 'up', 'down' or 'echo'.")
 
 # Run the sender
 if __name__ == "__main__":
@@ -339,17 +654,47 @@ if __name__ == "__main__":
     parser.add_argument('-r', '--rate', type=int, default=1,
                         help='Packet rate (default: 1)')
     parser.add_argument('-d', '--direction', type=validate_direction,
-                        required=True, help='Direction (up or down)')
+                        required=True, help='Direction (up, down or echo)')
+    parser.add_argument('-t', '--pattern', type=str, default='cbr',
+                        choices=list(patterns.PATTERNS),
+                        help='Traffic pattern (default: cbr)')
+    parser.add_argument('--on-ms', type=int, default=0,
+                        help='On period of the onoff pattern (ms)')
+    parser.add_argument('--off-ms', type=int, default=0,
+                        help='Idle gap of the onoff pattern (ms)')
+    parser.add_argument('--burst-size', type=int, default=1,
+                        help='Packets per burst of the burst pattern')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the poisson pattern')
+    parser.add_argument('-f', '--flows', type=int, default=1,
+                        help='Spread the packets over this number of source '
+                             'ports (for upload, default: 1)')
     parser.add_argument('-i', '--interface', type=str,
                         help='Network interface for tcpdump (for upload)')
+    parser.add_argument('-s', '--sqlite', type=str,
+                        help='Also store results in this SQLite database '
+                             '(for download and echo)')
+    parser.add_argument('-a', '--arrival-log', type=str,
+                        help='Record every packet arrival in this file '
+                             '(for download and echo)')
+    parser.add_argument('-m', '--metrics-port', type=int,
+                        help='Serve live metrics on localhost:PORT/metrics')
 
     # Parse the arguments
     args = parser.parse_args()
 
     try:
+        pattern = patterns.TrafficPattern(args.pattern, on_ms=args.on_ms,
+                                          off_ms=args.off_ms,
+                                          burst_size=args.burst_size,
+                                          seed=args.seed)
         client = UDPClient(host=args.host, packets_to_send=args.npackets,
                            rate=args.rate, direction=args.direction,
-                           interface=args.interface)
+                           interface=args.interface,
+                           sqlite_file=args.sqlite,
+                           arrival_log=args.arrival_log,
+                           metrics_port=args.metrics_port,
+                           pattern=pattern, flows=args.flows)
         client.start()
     except KeyboardInterrupt:
         client.stop()
@@ -1,6 +1,31 @@
 import time
 import datetime
+import itertools
 import os
+import struct
+from array import array
+from collections import defaultdict
+
+# Session directions, as carried in the packet header
+DIRECTION_UP = 0
+DIRECTION_DOWN = 1
+# the server reflects every data packet back to the client
+DIRECTION_ECHO = 2
+
+# Every packet is 64 bytes long and starts with a header made of 4 bytes
+# fields (network byte order): packet ID, packet number, packet rate, total
+# packets and direction. Echo packets also carry, in the padding, the client
+# send timestamp (8 bytes, ns) and the server echo counter (4 bytes).
+# Packets of multi-flow sessions carry the flow index and the number of flows
+# (2 bytes each); the traffic pattern is at offset 32 (see patterns.py).
+PACKET_SIZE = 64
+HEADER = struct.Struct('!IIIII')
+ECHO_TIMESTAMP = struct.Struct('!Q')
+ECHO_TIMESTAMP_OFFSET = 20
+ECHO_COUNTER = struct.Struct('!I')
+ECHO_COUNTER_OFFSET = 28
+FLOW = struct.Struct('!HH')
+FLOW_OFFSET = 52
 
 def get_timestamp_filename(name):
     current_time = datetime.datetime.now()
@@ -19,6 +44,122 @@ def get_pcap_fullpath(pcap_name):
 def send_rate_sleep(packet_rate):
     time.sleep(1 / packet_rate)
 
+# Table of per-session stats dictionaries (packet ID -> stats) supporting cheap
+# consistent snapshots while other threads keep updating it, without locks.
+#
+# Writers bump the epoch of a session with touch() *after* updating its stats.
+# snapshot() copies only the sessions whose epoch changed since the previous
+# snapshot and reuses the previous copies for all the others. Copying a flat
+# dictionary (or the list of keys) is atomic w.r.t. the other Python threads,
+# so every returned copy is a stable view that can be serialized while the
+# table keeps changing. Stats values providing a snapshot() method are
+# replaced by their snapshot, which must be a stable copy as well.
+class SessionTable(defaultdict):
+    def __init__(self, default_factory):
+        super().__init__(default_factory)
+        self.epochs = defaultdict(int)
+        # epochs are taken from a single counter, so that a session never
+        # gets back an epoch already cached by snapshot()
+        self.clock = itertools.count(1)
+        # packet ID -> (epoch, stats copy) of the last snapshot
+        self.snapshots = {}
+
+    # Notify that the stats of a session have been updated
+    def touch(self, key):
+        self.epochs[key] = next(self.clock)
+
+    # Return a {packet ID: stats copy} view of the table. The returned
+    # dictionaries are shared between snapshots and must not be modified.
+    def snapshot(self):
+        previous = self.snapshots
+        snapshots = {}
+
+        for key in list(self.keys()):
+            # read the epoch first: a concurrent update makes the copy newer
+            # than the epoch, and the next snapshot will take it again.
+            epoch = self.epochs.get(key, 0)
+            cached = previous.get(key)
+            if cached is not None and cached[0] == epoch:
+                snapshots[key] = cached
+                continue
+
+            stats = self.get(key)
+            if stats is not None:
+                snapshots[key] = (epoch, self.copy_stats(stats))
+
+        self.snapshots = snapshots
+        return {key: stats for key, (_, stats) in snapshots.items()}
+
+    def copy_stats(self, stats):
+        stats = stats.copy()
+        # nested stats objects (e.g., FlowStats) provide their own snapshot
+        for name, value in stats.items():
+            if hasattr(value, 'snapshot'):
+                stats[name] = value.snapshot()
+        return stats
+
+# Per-flow accounting of a multi-flow session. Packet number N of a session
+# with K flows is sent on flow N % K, so that flow f expects
+# ceil((total_packets - f) / K) packets.
+class FlowStats:
+    # per-flow counters, see FlowStats.counters
+    RECEIVED = 0
+    DUPLICATES = 1
+    # packets received after a packet with a higher number on the same flow
+    REORDERED = 2
+
+    def __init__(self, nflows, total_packets):
+        self.nflows = nflows
+        self.total_packets = total_packets
+        # the counters of flow f are at 3 * f + RECEIVED/DUPLICATES/REORDERED,
+        # all in one array so that snapshot() copies them at once
+        self.counters = array('Q', [0]) * (3 * nflows)
+        self.last_seq = array('q', [-1]) * nflows
+        self.remotes = [None] * nflows
+
+    # Count a packet of the given flow. count is the value returned by
+    # MSession.count_packet() for the packet.
+    def count_packet(self, flow, number, count, remote):
+        self.remotes[flow] = remote
+
+        if count == (2 ** 32) - 1:
+            # control packet for starting tx
+            return
+
+        if count != 1:
+            self.counters[3 * flow + self.DUPLICATES] += 1
+            return
+
+        self.counters[3 * flow + self.RECEIVED] += 1
+        if number < self.last_seq[flow]:
+            self.counters[3 * flow + self.REORDERED] += 1
+        else:
+            self.last_seq[flow] = number
+
+    # Return the stats of every flow. The missing packets of a session still
+    # in progress include the ones not sent yet.
+    def snapshot(self):
+        # a single copy: consistent w.r.t. the receive thread
+        counters = self.counters.tolist()
+        remotes = list(self.remotes)
+        nflows = self.nflows
+        total = self.total_packets
+
+        flows = []
+        for flow in range(nflows):
+            received = counters[3 * flow + self.RECEIVED]
+            expected = (total - flow + nflows - 1) // nflows
+            flows.append({
+                'flow': flow,
+                'received': received,
+                'duplicates': counters[3 * flow + self.DUPLICATES],
+                'reordered': counters[3 * flow + self.REORDERED],
+                'missing': max(0, expected - received),
+                'remote': remotes[flow],
+            })
+
+        return flows
+
 class MSession:
     def __init__(self, packet_id, max_packets):
         self.packet_id = packet_id
@@ -78,11 +219,14 @@ class MSession:
 
         return compressed_ranges
 
-    def write_missing_packets(self):
+    # The missing ranges can be passed by the caller to avoid recomputing
+    # them.
+    def write_missing_packets(self, data_list=None):
         key = self.packet_id
         filename = f"data/missing_packets_{key}.txt"
 
-        data_list = self.get_missing_packets_seqnum()
+        if data_list is None:
+            data_list = self.get_missing_packets_seqnum()
         if not data_list:
             # missing packet list is empty, e.g., no packet missing
             return
@@ -0,0 +1,120 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Lightweight counters and sampled timers, exposed in the Prometheus text
+# format through a local HTTP endpoint.
+#
+# Counters are plain integer increments. Timers are only fed one packet out of
+# sample_every (see Metrics.sample()), so the hot path pays two
+# perf_counter_ns() calls per stage just for the sampled packets.
+# Updates are not locked: when several threads update the same metric a few
+# increments may be lost, which is fine for monitoring purposes.
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def render(self):
+        return (f"# HELP {self.name} {self.help}\n"
+                f"# TYPE {self.name} counter\n"
+                f"{self.name} {self.value}\n")
+
+class Gauge:
+    def __init__(self, name, help, func):
+        self.name = name
+        self.help = help
+        # the value is computed when rendering
+        self.func = func
+
+    def render(self):
+        return (f"# HELP {self.name} {self.help}\n"
+                f"# TYPE {self.name} gauge\n"
+                f"{self.name} {self.func()}\n")
+
+class Timer:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.count = 0
+        self.sum_ns = 0
+        self.max_ns = 0
+
+    def observe(self, elapsed_ns):
+        self.count += 1
+        self.sum_ns += elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+
+    def render(self):
+        return (f"# HELP {self.name} {self.help}\n"
+                f"# TYPE {self.name} summary\n"
+                f"{self.name}_sum {self.sum_ns / 1e9}\n"
+                f"{self.name}_count {self.count}\n"
+                f"# HELP {self.name}_max Maximum of {self.name}\n"
+                f"# TYPE {self.name}_max gauge\n"
+                f"{self.name}_max {self.max_ns / 1e9}\n")
+
+class Metrics:
+    def __init__(self, prefix, sample_every=64):
+        self.prefix = prefix
+        self.sample_every = sample_every
+        self.ticks = 0
+        self.metrics = []
+        self.httpd = None
+
+    def counter(self, name, help):
+        metric = Counter(f"{self.prefix}_{name}_total", help)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, func):
+        metric = Gauge(f"{self.prefix}_{name}", help, func)
+        self.metrics.append(metric)
+        return metric
+
+    def timer(self, name, help):
+        metric = Timer(f"{self.prefix}_{name}_seconds", help)
+        self.metrics.append(metric)
+        return metric
+
+    # Return True if the timers should be fed for the current packet
+    def sample(self):
+        self.ticks += 1
+        return self.ticks % self.sample_every == 0
+
+    def render(self):
+        return ''.join(metric.render() for metric in self.metrics)
+
+    # Serve the metrics on http://host:port/metrics from a background thread
+    def serve(self, port, host='127.0.0.1'):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # do not pollute the output with access logs
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
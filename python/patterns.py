@@ -0,0 +1,208 @@
+import random
+import struct
+import time
+from array import array
+
+# Traffic patterns for the senders.
+#
+# A pattern turns a packet rate into the schedule of send offsets (seconds
+# from the start of the transmission) of every packet, replayed by the
+# sender's pacer (see pace()) against an absolute clock. The schedule is built
+# before the transmission starts, so the pacer never stalls computing it: the
+# offsets of the periodic patterns are computed on access, while the poisson
+# ones are drawn up front (8 bytes per packet).
+#
+# The average rate is packet_rate for every pattern but onoff, which sends at
+# packet_rate during the on periods only.
+
+CBR = 0
+POISSON = 1
+ONOFF = 2
+BURST = 3
+
+PATTERNS = {
+    'cbr': CBR,
+    'poisson': POISSON,
+    'onoff': ONOFF,
+    'burst': BURST,
+}
+
+# Pattern fields carried in the packet padding: pattern, on_ms, off_ms,
+# burst_size and seed (4 bytes each, network byte order).
+WIRE = struct.Struct('!IIIII')
+WIRE_OFFSET = 32
+
+# Constant bit rate schedule: packet i is sent at i * interval
+class Schedule:
+    def __init__(self, npackets, interval):
+        self.npackets = npackets
+        self.interval = interval
+
+    def __len__(self):
+        return self.npackets
+
+    def __getitem__(self, i):
+        return i * self.interval
+
+    # offsets are not bounds checked, index them up to len() (see pace())
+    __iter__ = None
+
+    # Send offset of the last packet
+    def last(self):
+        return self[self.npackets - 1] if self.npackets else 0.0
+
+    # Upper bound of the idle time between two consecutive packets
+    def max_gap(self):
+        return self.interval
+
+class OnOffSchedule(Schedule):
+    def __init__(self, npackets, interval, per_period, period):
+        super().__init__(npackets, interval)
+        # packets sent in every on period
+        self.per_period = per_period
+        self.period = period
+
+    def __getitem__(self, i):
+        return ((i // self.per_period) * self.period +
+                (i % self.per_period) * self.interval)
+
+    def max_gap(self):
+        # from the last packet of an on period to the next period
+        return max(self.interval,
+                   self.period - (self.per_period - 1) * self.interval)
+
+# Bursts of back-to-back packets, keeping the average rate
+class BurstSchedule(Schedule):
+    def __init__(self, npackets, interval, burst_size):
+        super().__init__(npackets, interval)
+        self.burst_size = burst_size
+
+    def __getitem__(self, i):
+        return (i // self.burst_size) * self.burst_size * self.interval
+
+    def max_gap(self):
+        return self.burst_size * self.interval
+
+class PoissonSchedule(Schedule):
+    def __init__(self, npackets, packet_rate, seed):
+        super().__init__(npackets, 1.0 / packet_rate)
+        rng = random.Random(seed)
+        self.offsets = array('d', bytes(8 * npackets))
+        elapsed = 0.0
+        self.gap = self.interval
+        for i in range(npackets):
+            self.offsets[i] = elapsed
+            gap = rng.expovariate(packet_rate)
+            elapsed += gap
+            if gap > self.gap:
+                self.gap = gap
+
+    def __getitem__(self, i):
+        return self.offsets[i]
+
+    def max_gap(self):
+        return self.gap
+
+class TrafficPattern:
+    def __init__(self, name='cbr', on_ms=0, off_ms=0, burst_size=1, seed=0):
+        if name not in PATTERNS:
+            raise ValueError(f"unknown traffic pattern: '{name}'")
+        if name == 'onoff' and on_ms <= 0:
+            raise ValueError("onoff pattern requires on_ms > 0")
+        if burst_size < 1:
+            raise ValueError("burst_size must be at least 1")
+
+        self.name = name
+        self.on_ms = on_ms
+        self.off_ms = off_ms
+        self.burst_size = burst_size
+        self.seed = seed
+
+    @classmethod
+    def from_dict(cls, params):
+        return cls(**params)
+
+    def to_dict(self):
+        params = {'name': self.name}
+        if self.name == 'onoff':
+            params['on_ms'] = self.on_ms
+            params['off_ms'] = self.off_ms
+        elif self.name == 'burst':
+            params['burst_size'] = self.burst_size
+        elif self.name == 'poisson':
+            params['seed'] = self.seed
+        return params
+
+    def pack(self):
+        return WIRE.pack(PATTERNS[self.name], self.on_ms, self.off_ms,
+                         self.burst_size, self.seed)
+
+    @classmethod
+    def unpack_from(cls, buf):
+        pattern, on_ms, off_ms, burst_size, seed = WIRE.unpack_from(
+                buf, WIRE_OFFSET)
+        for name, value in PATTERNS.items():
+            if value == pattern:
+                break
+        else:
+            # unknown pattern (e.g., newer client), fall back to CBR
+            name = 'cbr'
+
+        try:
+            return cls(name, on_ms, off_ms, burst_size, seed)
+        except ValueError:
+            return cls()
+
+    # Return the send offsets of npackets packets, as a sequence
+    def schedule(self, packet_rate, npackets):
+        interval = 1.0 / packet_rate
+
+        if self.name == 'poisson':
+            return PoissonSchedule(npackets, packet_rate, self.seed)
+        elif self.name == 'onoff':
+            per_period = max(1, round(packet_rate * self.on_ms / 1000))
+            period = (self.on_ms + self.off_ms) / 1000
+            return OnOffSchedule(npackets, interval, per_period, period)
+        elif self.name == 'burst':
+            return BurstSchedule(npackets, interval, self.burst_size)
+
+        return Schedule(npackets, interval)
+
+    # How long a receiver should wait for the next packet before giving up:
+    # longer than the whole schedule, and than any idle gap in it. For CBR
+    # this is the nominal duration npackets / packet_rate.
+    def receive_timeout(self, packet_rate, npackets):
+        schedule = self.schedule(packet_rate, npackets)
+        return schedule.last() + schedule.max_gap()
+
+# Yield the index of every packet of the schedule at its send time, busy
+# waiting against an absolute clock. A sender falling behind by more than one
+# interval (e.g., descheduled) does not catch up with a back-to-back burst,
+# which could cause losses of its own: the rest of the schedule is shifted
+# instead, so a stall only lowers the rate. Lateness is accounted in metrics
+# (packets_late, pacing_lateness) if given.
+def pace(schedule, metrics=None):
+    interval = schedule.interval
+    # packets sharing a send slot (a burst) go back to back and only the
+    # first of them can be late, the first packet is never late
+    last_offset = 0.0
+
+    start = time.perf_counter()
+    for i in range(len(schedule)):
+        offset = schedule[i]
+        target = start + offset
+        now = time.perf_counter()
+        if offset != last_offset and now > target:
+            if metrics:
+                metrics.late.value += 1
+            if now - target > interval:
+                start += now - target
+        last_offset = offset
+
+        while now < target:
+            now = time.perf_counter()
+
+        if metrics and metrics.sample():
+            metrics.pacing.observe(int((now - target) * 1e9))
+
+        yield i
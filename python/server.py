@@ -10,14 +10,56 @@ import datetime
 import traceback
 import argparse
 import common
+import sqlstore
+import arrivallog
+import metrics
+import patterns
 import subprocess
 import signal
-from collections import defaultdict
+
+class ServerMetrics(metrics.Metrics):
+    def __init__(self, sample_every=64):
+        super().__init__('udploss_server', sample_every)
+        self.received = self.counter('packets_received',
+                                     'Packets received on the socket')
+        self.received_bytes = self.counter('bytes_received',
+                                           'Bytes received on the socket')
+        self.short = self.counter('packets_short',
+                                  'Received packets shorter than 64 bytes')
+        self.dropped_dying = self.counter('packets_dying',
+                                          'Packets received for dying sessions')
+        self.sent = self.counter('packets_sent',
+                                 'Packets sent for download sessions')
+        self.echoed = self.counter('packets_echoed',
+                                   'Packets reflected for echo sessions')
+        self.late = self.counter('packets_late',
+                                 'Packets sent after their pacing slot')
+        self.recv_wait = self.timer('receive_syscall',
+                                    'Time spent in recvfrom(), including the '
+                                    'wait for data (sampled)')
+        self.decode = self.timer('header_decode',
+                                 'Time spent decoding headers (sampled)')
+        self.arrival_log = self.timer('arrival_log',
+                                      'Time spent writing the arrival log '
+                                      '(sampled)')
+        self.lookup = self.timer('session_lookup',
+                                 'Time spent looking up sessions (sampled)')
+        self.accounting = self.timer('accounting',
+                                     'Time spent counting packets (sampled)')
+        self.pacing = self.timer('pacing_lateness',
+                                 'Delay of the sender past its pacing slot '
+                                 '(sampled)')
+        self.persistence = self.timer('persistence',
+                                      'Time spent saving the results')
+        self.gc_scan = self.timer('gc_scan',
+                                  'Duration of the session GC scans')
 
 class PacketManager:
     def __init__(self, packet_info, tcpdump_processes, session_timeout=60,
-                 gc_timeout=30):
+                 gc_timeout=30, store=None, metrics=None):
         self.tcpdump_processes = tcpdump_processes
+        self.store = store
+        self.metrics = metrics
         self.session_timeout = session_timeout
         self.cleanup_interval = gc_timeout
         self.packet_info = packet_info
@@ -44,20 +86,27 @@ class PacketManager:
     # Periodically clean up old sessions
     def cleanup_sessions_core(self):
         while self.running:
+            start_ns = time.perf_counter_ns()
             current_time = time.time()
             keys_to_delete = []
-            for key, session in self.data.items():
+            # the receive thread may add sessions while we are scanning
+            for key, session in list(self.data.items()):
                 if current_time - session.timestamp > self.session_timeout:
                     keys_to_delete.append(key)
 
             for key in keys_to_delete:
                 # persist the missing packet sequence numbers before destroying
                 # the session to reclaim space.
-                self.data[key].write_missing_packets()
+                missing = self.data[key].get_missing_packets_seqnum()
+                self.data[key].write_missing_packets(missing)
+                if self.store:
+                    self.store.save_missing_ranges(
+                            key, self.packet_info[key]['first_seen'], missing)
 
                 del self.data[key]
                 # mark the packet info element as dying...
                 self.packet_info[key]['dying'] = True
+                self.packet_info.touch(key)
 
                 # Stop tcpdump if session is dying
                 if key in self.tcpdump_processes:
@@ -71,6 +120,9 @@ class PacketManager:
 
                     del self.tcpdump_processes[key]
 
+            if self.metrics:
+                self.metrics.gc_scan.observe(time.perf_counter_ns() - start_ns)
+
             time.sleep(self.cleanup_interval)
 
     def cleanup_sessions(self):
@@ -90,11 +142,12 @@ class PacketManager:
 # Define the UDP server
 class UDPServer:
     def __init__(self, host='0.0.0.0', port=12345, tcpdump_interface=None,
-                 output_file=None):
+                 output_file=None, sqlite_file=None, arrival_log=None,
+                 metrics_port=None):
         # Each packet ID will map to a dictionary with count, first_seen,
         # last_seen, packet_rate, total_packets, direction and the remote
         # endpoint (e.g., the connecting client).
-        self.packet_info = defaultdict(lambda: {
+        self.packet_info = common.SessionTable(lambda: {
             'count': 0,
             'duplicates': 0,
             'first_seen': None,
@@ -104,10 +157,23 @@ class UDPServer:
             'direction': 0,
             'dying': False,
             'remote': None,
+            'pattern': None,
+            'flows': None,
         })
         self.tcpdump_processes = {}  # structure to hold tcpdump PIDs
+        # optional SQLite backend, written off the receive thread
+        self.store = (sqlstore.SQLiteStore(sqlite_file, "server")
+                      if sqlite_file else None)
+        # optional instrumentation, served over HTTP
+        self.metrics_port = metrics_port
+        self.metrics = ServerMetrics() if metrics_port is not None else None
+        if self.metrics:
+            self.metrics.gauge('sessions', 'Sessions tracked by the GC',
+                               lambda: len(self.packet_manager.data))
         self.packet_manager = PacketManager(self.packet_info,
-                                            self.tcpdump_processes)
+                                            self.tcpdump_processes,
+                                            store=self.store,
+                                            metrics=self.metrics)
         self.tcpdump_interface = tcpdump_interface
         self.server_address = (host, port)
         self.lock = threading.Lock()
@@ -118,10 +184,19 @@ class UDPServer:
         self.output_file = (common.get_timestamp_filename("server")
                             if output_file is None else output_file)
 
+        # optional per-packet arrival log
+        self.recorder = (arrivallog.ArrivalRecorder(arrival_log)
+                         if arrival_log else None)
+
     def start(self):
         # Create a UDP socket
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind(self.server_address)
+        if self.recorder:
+            arrivallog.enable_kernel_timestamps(self.sock)
+
+        if self.metrics:
+            self.metrics.serve(self.metrics_port)
 
         # Start the display thread
         display_thread = threading.Thread(target=self.save_counts_to_file,
@@ -154,18 +229,21 @@ class UDPServer:
         packet_rate = self.packet_info[packet_id]['packet_rate']
         total_packets = self.packet_info[packet_id]['total_packets']
         direction = self.packet_info[packet_id]['direction']
+        pattern = patterns.TrafficPattern.from_dict(
+                self.packet_info[packet_id]['pattern'])
+        metrics = self.metrics
 
-        for i in range(total_packets):
-            budget = time.perf_counter() + (1.0 / packet_rate)
-
+        offsets = pattern.schedule(packet_rate, total_packets)
+        for i in patterns.pace(offsets, metrics):
             packet_num = i
             self.packet_info[packet_id]['count'] += 1
+            self.packet_info.touch(packet_id)
 
             self.send_packet(remote_address, packet_id, packet_num, packet_rate,
                              total_packets, direction)
 
-            while time.perf_counter() - budget < 0:
-                pass
+            if metrics:
+                metrics.sent.value += 1
 
     def send_packets_non_blocking(self, packet_id):
         current_time = time.time()
@@ -190,8 +268,13 @@ class UDPServer:
             pcap_name = f"tcpdump_server_up_{packet_id}.pcap"
             pcap_fullname = common.get_pcap_fullpath(pcap_name)
 
+            tcpdump_filter = f'udp and src host {srchost} and dst port {self.port}'
+            if self.packet_info[packet_id]['flows'] is None:
+                # multi-flow sessions use several source ports
+                tcpdump_filter += f' and src port {srcport}'
+
             command = ['tcpdump', '-i', self.tcpdump_interface,
-                        f'udp and src host {srchost} and src port {srcport} and dst port {self.port}',
+                        tcpdump_filter,
                         '-w', f'{pcap_fullname}']
             process = subprocess.Popen(command)
             # Store the PID
@@ -212,9 +295,18 @@ class UDPServer:
             del self.tcpdump_processes[packet_id]
 
     def receive_packet_finish(self, packet_id, packet_number,
-                              total_num_packets):
+                              total_num_packets, flow=0, nflows=0,
+                              remote=None):
         current_time = time.time()
 
+        flows = None
+        if nflows > 1 and flow < nflows:
+            # multi-flow session, account each flow on its own as well
+            flows = self.packet_info[packet_id]['flows']
+            if flows is None:
+                flows = common.FlowStats(nflows, total_num_packets)
+                self.packet_info[packet_id]['flows'] = flows
+
         if self.packet_info[packet_id]['first_seen'] is None:
             self.packet_info[packet_id]['first_seen'] = current_time
 
@@ -228,6 +320,9 @@ class UDPServer:
                                                              packet_number,
                                                              total_num_packets)
 
+        if flows is not None and flows.nflows == nflows:
+            flows.count_packet(flow, packet_number, packet_number_cnt, remote)
+
         if packet_number_cnt == (2 ** 32) - 1:
             # control packet for starting tx, ignore it.
             return
@@ -238,39 +333,109 @@ class UDPServer:
         else:
             self.packet_info[packet_id]['duplicates'] += 1
 
+    # Reflect an echo packet back to the client, stamping the number of
+    # packets of the session received so far. The packet is modified in place
+    # in the receive buffer to avoid any allocation.
+    def echo_packet(self, packet_id, buf, packet_view, remote_address):
+        common.ECHO_COUNTER.pack_into(buf, common.ECHO_COUNTER_OFFSET,
+                                      self.packet_info[packet_id]['count'])
+        self.sock.sendto(packet_view, remote_address)
+
     def receive_packets(self):
+        recorder = self.recorder
+        metrics = self.metrics
+        sampled = False
+
+        # preallocated receive buffer, shared with the echo path
+        buf = bytearray(1024)  # Buffer size is 1024 bytes
+        packet_view = memoryview(buf)[:common.PACKET_SIZE]
+
         while self.running:
-            data, addr = self.sock.recvfrom(1024)  # Buffer size is 1024 bytes
-            if len(data) >= 64:
-                packet_id = int.from_bytes(data[:4], byteorder='big')
+            if metrics:
+                sampled = metrics.sample()
+                if sampled:
+                    t_recv = time.perf_counter_ns()
+
+            if recorder:
+                nbytes, addr, ts_ns = arrivallog.recvfrom_into_ts(self.sock,
+                                                                  buf)
+            else:
+                nbytes, addr = self.sock.recvfrom_into(buf)
+
+            if metrics:
+                metrics.received.value += 1
+                metrics.received_bytes.value += nbytes
+                if sampled:
+                    t_decode = time.perf_counter_ns()
+                    metrics.recv_wait.observe(t_decode - t_recv)
+
+            if nbytes >= common.PACKET_SIZE:
+                (packet_id, packet_number, packet_rate, total_packets,
+                 direction) = common.HEADER.unpack_from(buf)
+
+                if sampled:
+                    t_lookup = time.perf_counter_ns()
+                    metrics.decode.observe(t_lookup - t_decode)
+
+                if recorder:
+                    recorder.record(packet_id, packet_number, ts_ns)
+                    if sampled:
+                        t_record, t_lookup = t_lookup, time.perf_counter_ns()
+                        metrics.arrival_log.observe(t_lookup - t_record)
+
                 if self.packet_info[packet_id]['dying']:
+                    if metrics:
+                        metrics.dropped_dying.value += 1
                     continue
 
-                packet_rate = int.from_bytes(data[8:12], byteorder='big')
-                total_packets = int.from_bytes(data[12:16], byteorder='big')
-                direction = int.from_bytes(data[16:20], byteorder='big')
-
                 self.packet_info[packet_id]['remote'] = addr
                 self.packet_info[packet_id]['total_packets'] = total_packets
                 self.packet_info[packet_id]['packet_rate'] = packet_rate
                 self.packet_info[packet_id]['direction'] = direction
+                if self.packet_info[packet_id]['pattern'] is None:
+                    pattern = patterns.TrafficPattern.unpack_from(buf)
+                    self.packet_info[packet_id]['pattern'] = pattern.to_dict()
 
-                if direction > 0:
+                if direction == common.DIRECTION_DOWN:
                     self.send_packets_non_blocking(packet_id)
+                    self.packet_info.touch(packet_id)
                     continue
 
-                packet_number = int.from_bytes(data[4:8], byteorder='big')
+                if sampled:
+                    t_accounting = time.perf_counter_ns()
+                    metrics.lookup.observe(t_accounting - t_lookup)
 
+                flow, nflows = common.FLOW.unpack_from(buf, common.FLOW_OFFSET)
                 self.receive_packet_finish(packet_id, packet_number,
-                                           total_packets)
+                                           total_packets, flow, nflows, addr)
+                self.packet_info.touch(packet_id)
+
+                if sampled:
+                    metrics.accounting.observe(time.perf_counter_ns() -
+                                               t_accounting)
+
+                if (direction == common.DIRECTION_ECHO and
+                        packet_number != (2 ** 32) - 1):
+                    self.echo_packet(packet_id, buf, packet_view, addr)
+                    if metrics:
+                        metrics.echoed.value += 1
+            elif metrics:
+                metrics.short.value += 1
 
     def save_to_json(self):
-        packet_info_copy = self.packet_info.copy()
+        start_ns = time.perf_counter_ns()
+        packet_info_copy = self.packet_info.snapshot()
 
         with open(self.output_file, 'w') as json_file:
             json.dump(packet_info_copy, json_file, indent=4)
             print(f"Saved packet counts to {self.output_file}")
 
+        if self.store:
+            self.store.save_sessions(packet_info_copy)
+
+        if self.metrics:
+            self.metrics.persistence.observe(time.perf_counter_ns() - start_ns)
+
     def save_counts_to_file(self):
         while self.running:
             time.sleep(5)
@@ -280,8 +445,21 @@ class UDPServer:
         self.running = False
         self.sock.close()
         self.packet_manager.stop()
+        # missing ranges of the sessions not collected yet, which are
+        # otherwise only stored when a session is destroyed
+        if self.store:
+            for key, session in list(self.packet_manager.data.items()):
+                self.store.save_missing_ranges(
+                        key, self.packet_info[key]['first_seen'],
+                        session.get_missing_packets_seqnum())
         # save on disk
         self.save_to_json()
+        if self.store:
+            self.store.stop()
+        if self.recorder:
+            self.recorder.close()
+        if self.metrics:
+            self.metrics.stop()
         # Stop tcpdump processes for all active sessions
         for packet_id in list(self.tcpdump_processes.keys()):
             self.stop_tcpdump(packet_id)
@@ -295,12 +473,21 @@ if __name__ == "__main__":
                         help='Local port')
     parser.add_argument('-i', '--interface', type=str,
                         help='Network interface for tcpdump')
+    parser.add_argument('-s', '--sqlite', type=str,
+                        help='Also store results in this SQLite database')
+    parser.add_argument('-a', '--arrival-log', type=str,
+                        help='Record every packet arrival in this file')
+    parser.add_argument('-m', '--metrics-port', type=int,
+                        help='Serve live metrics on localhost:PORT/metrics')
 
     args = parser.parse_args()
 
     try:
         server = UDPServer(host=args.bind, port=args.port,
-                           tcpdump_interface=args.interface)
+                           tcpdump_interface=args.interface,
+                           sqlite_file=args.sqlite,
+                           arrival_log=args.arrival_log,
+                           metrics_port=args.metrics_port)
         server.start()
 
         while True:
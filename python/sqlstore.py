@@ -0,0 +1,273 @@
+import sqlite3
+import threading
+import queue
+import time
+import os
+import traceback
+import common
+
+# Sessions are identified by (role, packet_id, first_seen): packet IDs are
+# random and may be reused by different clients over a long time span.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    role          TEXT    NOT NULL,
+    packet_id     INTEGER NOT NULL,
+    first_seen    REAL    NOT NULL,
+    last_seen     REAL,
+    packet_rate   INTEGER,
+    total_packets INTEGER,
+    direction     INTEGER,
+    count         INTEGER,
+    duplicates    INTEGER,
+    remote        TEXT,
+    PRIMARY KEY (role, packet_id, first_seen)
+);
+CREATE TABLE IF NOT EXISTS missing_ranges (
+    role       TEXT    NOT NULL,
+    packet_id  INTEGER NOT NULL,
+    first_seen REAL    NOT NULL,
+    range_start INTEGER NOT NULL,
+    range_end   INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_by_id ON sessions (packet_id);
+CREATE INDEX IF NOT EXISTS sessions_by_time ON sessions (first_seen);
+CREATE INDEX IF NOT EXISTS sessions_by_rate
+    ON sessions (packet_rate, direction, first_seen);
+CREATE INDEX IF NOT EXISTS missing_by_session
+    ON missing_ranges (role, packet_id, first_seen);
+"""
+
+UPSERT_SESSION = """
+INSERT INTO sessions (role, packet_id, first_seen, last_seen, packet_rate,
+                      total_packets, direction, count, duplicates, remote)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (role, packet_id, first_seen) DO UPDATE SET
+    last_seen = excluded.last_seen,
+    packet_rate = excluded.packet_rate,
+    total_packets = excluded.total_packets,
+    direction = excluded.direction,
+    count = excluded.count,
+    duplicates = excluded.duplicates,
+    remote = excluded.remote
+"""
+
+DELETE_MISSING = """
+DELETE FROM missing_ranges WHERE role = ? AND packet_id = ? AND first_seen = ?
+"""
+
+INSERT_MISSING = """
+INSERT INTO missing_ranges (role, packet_id, first_seen, range_start,
+                            range_end)
+VALUES (?, ?, ?, ?, ?)
+"""
+
+def format_remote(remote):
+    if remote is None:
+        return None
+
+    host, port = remote
+    return f"{host}:{port}"
+
+# Store session summaries and missing ranges in a SQLite database. All the
+# writes are queued and performed by a background thread in batched
+# transactions, so callers (e.g., the receive path) never wait for the disk.
+class SQLiteStore:
+    def __init__(self, filename, role, batch_size=1000, flush_interval=1.0):
+        self.filename = filename
+        self.role = role
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.running = True
+        # packet ID -> session row last queued
+        self.saved = {}
+
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        # Create the schema synchronously, so that errors (e.g., wrong path)
+        # are reported to the caller right away.
+        conn = self.connect()
+        conn.executescript(SCHEMA)
+        conn.close()
+
+        self.writer_thread = threading.Thread(target=self.writer, daemon=True)
+        self.writer_thread.start()
+
+    def connect(self):
+        conn = sqlite3.connect(self.filename, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # Queue the summary of the sessions changed since the previous call, so
+    # that long finished sessions are not written over and over.
+    def save_sessions(self, packet_info):
+        rows = []
+        saved = self.saved
+        for packet_id, info in packet_info.items():
+            if info['first_seen'] is None:
+                # nothing received/sent yet
+                continue
+
+            row = (self.role, packet_id, info['first_seen'],
+                   info['last_seen'], info['packet_rate'],
+                   info['total_packets'], info['direction'], info['count'],
+                   info['duplicates'], format_remote(info.get('remote')))
+            if saved.get(packet_id) == row:
+                continue
+
+            saved[packet_id] = row
+            rows.append(row)
+
+        if rows:
+            self.queue.put((UPSERT_SESSION, rows))
+
+    # Queue the missing ranges of a session, replacing any previous ones.
+    def save_missing_ranges(self, packet_id, first_seen, ranges):
+        if first_seen is None:
+            return
+
+        key = (self.role, packet_id, first_seen)
+        self.queue.put((DELETE_MISSING, [key]))
+        if ranges:
+            self.queue.put((INSERT_MISSING,
+                            [key + (start, end) for start, end in ranges]))
+
+    def write_batch(self, conn, batch):
+        with conn:
+            for statement, rows in batch:
+                conn.executemany(statement, rows)
+
+    def writer_core(self):
+        conn = self.connect()
+        stopping = False
+
+        while not stopping:
+            batch = []
+            nrows = 0
+            deadline = time.monotonic() + self.flush_interval
+
+            # Gather queued items until the batch is full or the flush
+            # interval has elapsed.
+            while nrows < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+
+                if item is None:
+                    stopping = True
+                    break
+
+                batch.append(item)
+                nrows += len(item[1])
+
+            if batch:
+                self.write_batch(conn, batch)
+
+        conn.close()
+
+    def writer(self):
+        try:
+            self.writer_core()
+        except Exception as e:
+            # do not kill the measurement because of the storage backend
+            tb_exception = traceback.TracebackException.from_exception(e)
+            print("An exception occurred in the SQLite writer:")
+            print(''.join(tb_exception.format()))
+
+    # Flush every pending write and stop the writer thread
+    def stop(self):
+        if not self.running:
+            return
+
+        self.running = False
+        self.queue.put(None)
+        self.writer_thread.join()
+
+# Read-only helpers for analysis
+class SQLiteQuery:
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(f"file:{filename}?mode=ro", uri=True)
+
+    def close(self):
+        self.conn.close()
+
+    # Return the number of sessions and the overall loss ratio (1 -
+    # received/total) for the sessions matching the given filters. Time bounds
+    # are UNIX timestamps applied to the session start.
+    #
+    # The loss is only known by the receiving side: use role 'server' for
+    # upload sessions (and the forward direction of echo sessions) and role
+    # 'client' for download sessions (and the round trip of echo sessions).
+    # For download sessions the server only records the packets it sent, so
+    # they are never taken into account for role 'server'.
+    def loss_ratio(self, packet_rate=None, direction=None, since=None,
+                   until=None, role='server'):
+        query = ("SELECT COUNT(*), SUM(count), SUM(total_packets) "
+                 "FROM sessions WHERE role = ?")
+        params = [role]
+
+        if role == 'server':
+            query += " AND direction != ?"
+            params.append(common.DIRECTION_DOWN)
+
+        if packet_rate is not None:
+            query += " AND packet_rate = ?"
+            params.append(packet_rate)
+        if direction is not None:
+            query += " AND direction = ?"
+            params.append(direction)
+        if since is not None:
+            query += " AND first_seen >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND first_seen < ?"
+            params.append(until)
+
+        nsessions, received, total = self.conn.execute(query,
+                                                       params).fetchone()
+        if not total:
+            return nsessions, None
+
+        return nsessions, 1 - received / total
+
+    def missing_ranges(self, packet_id, role='server'):
+        query = ("SELECT first_seen, range_start, range_end "
+                 "FROM missing_ranges WHERE role = ? AND packet_id = ? "
+                 "ORDER BY first_seen, range_start")
+        return self.conn.execute(query, (role, packet_id)).fetchall()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Query the SQLite results")
+    parser.add_argument('database', type=str, help='SQLite database file')
+    parser.add_argument('-r', '--rate', type=int, help='Packet rate')
+    parser.add_argument('-d', '--direction', type=int,
+                        help='Direction (0 up, 1 down, 2 echo)')
+    parser.add_argument('--days', type=float,
+                        help='Only consider sessions of the last N days')
+    parser.add_argument('--role', type=str, default='server',
+                        help='Role of the receiving side: server for upload, '
+                             'client for download (default: server)')
+
+    args = parser.parse_args()
+
+    since = None
+    if args.days is not None:
+        since = time.time() - args.days * 86400
+
+    db = SQLiteQuery(args.database)
+    nsessions, ratio = db.loss_ratio(packet_rate=args.rate,
+                                     direction=args.direction, since=since,
+                                     role=args.role)
+    db.close()
+
+    print(f"sessions: {nsessions}")
+    print(f"loss ratio: {ratio if ratio is None else round(ratio, 6)}")